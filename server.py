@@ -15,17 +15,23 @@
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from dotenv.main import load_dotenv
-
 from src.helpers import config, scheduler
 from src.plugins import schema, sio, emulation, plugins_load, plugins_run
 import asyncio
+import collections
 from datetime import datetime
 from time import time
-import json
-import os
+import orjson
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-_datastore = {}
+# Buffered samples per sensor, emitted and replaced every sio interval.
+_datastore = collections.defaultdict(list)
+# The sensor definitions do not change at runtime, so serialise them once for every namespace connect.
+_meta = orjson.dumps(config.sensors).decode()
 
 
 @schema.on('connect')
@@ -44,50 +50,50 @@ def _on_schema_disconnect(exc):
 def _on_emulation(data):
     if sio.client.connected:
         for sensor, values in data.items():
-            if sensor not in _datastore:
-                _datastore[sensor] = []
             _datastore[sensor].append(values)
 
 
 @schema.on('PDU')
 def _on_schema_pdu(pdu):
-    for sensor, value in filter(lambda entry: entry[0] != 'epoch', pdu.items()):
-        if sensor not in _datastore:
-            _datastore[sensor] = []
+    for sensor, value in pdu.items():
+        if sensor == 'epoch':
+            continue
         _datastore[sensor].append({'epoch': pdu['epoch'], 'value': value})
 
 
 @scheduler.schedule_job(scheduler.IntervalTrigger(seconds=sio.conf.getfloat('Interval')))
 def on_sio_client_emit():
-    if sio.client.connected:
-        if not _datastore == {}:
-            sio.client.emit('data', json.dumps(_datastore), sio.conf['Namespace'])
+    global _datastore
+    # Swap in a fresh buffer so samples arriving while this batch is encoded go into the next one.
+    data, _datastore = _datastore, collections.defaultdict(list)
 
-    _datastore.clear()
+    if sio.client.connected and data:
+        sio.client.emit('data', orjson.dumps(data).decode(), sio.namespace)
 
 
-@sio.client.on('connect', namespace=sio.conf['Namespace'])
+@sio.client.on('connect', namespace=sio.namespace)
 def on_sio_client_namespace_connect():
-    print(f'{sio.conf["Namespace"]} connect')
-    sio.client.emit('meta', json.dumps(config.sensors), sio.conf['Namespace'])
+    print(f'{sio.namespace} connect')
+    sio.client.emit('meta', _meta, sio.namespace)
 
 
-@sio.client.on('disconnect', namespace=sio.conf['Namespace'])
-def on_sio_client_namespace_connect():
-    print(f'{sio.conf["Namespace"]} disconnect')
+def _schedule_reconnect():
     wait = sio.conf.getint('RetryInterval')
     print(f'Attempting client restart in {wait}s')
 
     scheduler.add_job(sio.connect, scheduler.DateTrigger(datetime.fromtimestamp(time() + wait)))
 
 
+@sio.client.on('disconnect', namespace=sio.namespace)
+def on_sio_client_namespace_disconnect():
+    print(f'{sio.namespace} disconnect')
+    _schedule_reconnect()
+
+
 @sio.client.on('error')
 def _on_error(err):
     print(err)
-    wait = sio.conf.getint('RetryInterval')
-    print(f'Attempting client restart in {wait}s')
-
-    scheduler.add_job(sio.connect, scheduler.DateTrigger(datetime.fromtimestamp(time() + wait)))
+    _schedule_reconnect()
 
 
 if __name__ == '__main__':
@@ -95,6 +101,10 @@ if __name__ == '__main__':
           'This program comes with ABSOLUTELY NO WARRANTY;\n' +
           'This is free software, and you are welcome to redistribute it')
 
+    # uvloop is not available on Windows, fall back to the default asyncio loop.
+    if uvloop is not None:
+        uvloop.install()
+
     loop = asyncio.get_event_loop()
     asyncio.set_event_loop(loop)
 
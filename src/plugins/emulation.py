@@ -17,7 +17,6 @@
 """
 from src.helpers import config, scheduler
 from time import time
-import functools
 
 
 class _Modules:
@@ -27,23 +26,20 @@ class _Modules:
 
 _consumers = []
 _x = 0
+_modules = None
+_expressions = {}
 _conf = config.config['emulation']
 
 
 def _invoke_consumers():
     global _x
     data = {}
-    mods = {}
-
-    for module in _conf['Modules'].split(' '):
-        mods[module] = __import__(module)
-
-    mods = _Modules(mods)
     now = round(time(), 3)
+    scope = {"modules": _modules, "x": _x}
 
-    for sensor, conf in config.sensors.items():
+    for sensor, expression in _expressions.items():
         data[sensor] = {
-            "value": (lambda modules, x: eval(conf["emulation"]))(mods, _x),
+            "value": eval(expression, scope),
             "epoch": now
         }
     _x += 1
@@ -53,14 +49,14 @@ def _invoke_consumers():
 
 
 def on(func):
-    @functools.wraps(func)
-    def decorator(*args, **kwargs):
-        func(*args, **kwargs)
-
-    _consumers.append(decorator)
-    return decorator
+    _consumers.append(func)
+    return func
 
 
 def load():
+    global _modules
     if _conf.getboolean('Enable'):
+        _modules = _Modules({module: __import__(module) for module in _conf['Modules'].split(' ')})
+        for sensor, conf in config.sensors.items():
+            _expressions[sensor] = compile(conf["emulation"], sensor, 'eval')
         scheduler.add_job(_invoke_consumers, scheduler.IntervalTrigger(seconds=_conf.getfloat('Interval')))
@@ -16,69 +16,82 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from src.helpers import config
-import functools
 import asyncio
+import contextvars
+import collections
+import socket
 import serial
 from digi.xbee import devices as xbee_devices
 from digi.xbee.models import message as xbee_message
 import struct
 
 _event_handlers = {}
-_pdus = {}
+# Indexed by PDU id, None for ids not in the schema.
+_pdus = []
 _conf = config.config['schema']
+_start_byte = config.schema['startByte']
+_socket_buffer_size = 65536
 
 
 class _PDU:
+    __slots__ = ('name', 'length', 'fields', '_header', '_body', '_fields_names', '_struct')
+
     def __init__(self, name, header, body):
         self.name = name
-        self.length = 0
         self._header = header
         self._body = body
         self._fields_names = []
         self.fields = {}
 
-        self._struct_format = "<"
-
-        c_type_lengths = {"c": 1, "b": 1, "B": 1, "?": 1, "h": 2, "H": 2, "i": 4, "I": 4,
-                          "l": 4, "L": 4, "f": 4, "d": 8, "q": 8, "Q": 8}
+        struct_format = "<"
 
         for entry in self._header + self._body:
             self._fields_names.extend([entry['name']])
-            self.length += c_type_lengths[entry['cType']]
-            self._struct_format += entry['cType']
+            struct_format += entry['cType']
+
+        # The frame layout is fixed by the schema, so compile it once.
+        self._struct = struct.Struct(struct_format)
+        self.length = self._struct.size
 
         # Remove the valid_bitfield field.
         self._fields_names = self._fields_names[1:]
 
-    def decode(self, bytes_in):
-        values = iter(struct.unpack(self._struct_format, bytes_in))
-
+    def decode(self, buffer, offset):
         # The first value should be the valid bitfield.
-        valid_bitfield = next(values)
+        valid_bitfield, *values = self._struct.unpack_from(buffer, offset)
+
+        # Bit i of the valid bitfield is set when the ith field holds a value. Start from an empty dict so
+        # fields that are invalid in this frame are not reported with a value from an earlier one.
+        self.fields = {field: value for i, (field, value) in enumerate(zip(self._fields_names, values))
+                       if (valid_bitfield >> i) & 1}
 
-        # Create an array of valid fields in the PDU
-        valid_fields = []
-        for i in range(0, len(self._fields_names)):
-            if (valid_bitfield >> i) & 1:
-                valid_fields.extend([self._fields_names[i]])
 
-        for field in self._fields_names:
-            if field in valid_fields:
-                self.fields[field] = next(values)
-            else:
-                next(values)
+class _Socket(asyncio.BufferedProtocol):
+    __slots__ = ('_buffer', '_length')
 
+    def __init__(self):
+        # The transport reads straight into this buffer, a frame split across reads is kept at its start.
+        self._buffer = bytearray(_socket_buffer_size)
+        self._length = 0
 
-class _Socket(asyncio.Protocol):
     def connection_made(self, transport):
         if "connect" in _event_handlers:
             _event_handlers["connect"]()
 
-    def data_received(self, data):
+    def get_buffer(self, sizehint):
+        return memoryview(self._buffer)[self._length:]
+
+    def buffer_updated(self, nbytes):
+        self._length += nbytes
         try:
-            _parse_data(data)
+            consumed = _parse_data(memoryview(self._buffer)[:self._length])
         except Exception as error:
             print(f'Schema parse error: {error}')
+            consumed = self._length
+
+        # Move the incomplete frame, if any, to the start of the buffer.
+        self._buffer[:self._length - consumed] = self._buffer[consumed:self._length]
+        self._length -= consumed
 
     def connection_lost(self, exc):
         if "disconnect" in _event_handlers:
@@ -91,6 +104,12 @@ class _XBee:
         self.baud = baud
         self.mac_peer = mac_peer
         self.event_loop = asyncio.get_event_loop()
+        self._call_soon_threadsafe = self.event_loop.call_soon_threadsafe
+        # No context variables are used on the receive path, so share one context rather than copying per frame.
+        self._context = contextvars.copy_context()
+        # Frames received on the XBee thread, drained on the event loop. deque append/popleft are atomic.
+        self._inbox = collections.deque()
+        self._drain_scheduled = False
 
         self.xbee = xbee_devices.XBeeDevice(self.com, self.baud)
         self.xbee_remote = xbee_devices.RemoteXBeeDevice(
@@ -99,6 +118,9 @@ class _XBee:
         )
         try:
             self.xbee.open()
+            # pyserial only exposes the driver buffer size on Windows.
+            if hasattr(self.xbee.serial_port, 'set_buffer_size'):
+                self.xbee.serial_port.set_buffer_size(rx_size=_conf.getint('SerialRecvBuffer'))
             self.xbee.add_data_received_callback(self._on_xbee_receive)
             if "connect" in _event_handlers:
                 _event_handlers["connect"]()
@@ -107,64 +129,81 @@ class _XBee:
                 _event_handlers["disconnect"](err)
 
     def _on_xbee_receive(self, message: xbee_message.XBeeMessage):
-        data = bytes(message.data)
-
-        asyncio.run_coroutine_threadsafe(self._on_xbee_receive_async(data), self.event_loop)
-
-    @staticmethod
-    async def _on_xbee_receive_async(data):
-        try:
-            _parse_data(data)
-        except Exception as error:
-            print(error)
-
-
+        # digi-xbee builds a new bytearray per message, so it can be queued without copying.
+        self._inbox.append(message.data)
+
+        # Only wake the event loop once per burst, the drain picks up everything queued until it runs.
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self._call_soon_threadsafe(self._drain_inbox, context=self._context)
+
+    def _drain_inbox(self):
+        # Clear before draining so a frame queued after the last popleft schedules another drain.
+        self._drain_scheduled = False
+
+        while self._inbox:
+            data = self._inbox.popleft()
+            try:
+                # Each XBee message carries whole frames.
+                if _parse_data(data) != len(data):
+                    raise Exception('Invalid data length')
+            except Exception as error:
+                print(error)
+
+
+# Decodes every complete frame in data and returns the number of bytes consumed, parsing stops at a frame that has
+# not been fully received yet.
 def _parse_data(data):
+    on_pdu = _event_handlers.get('PDU')
     index = 0
     while index < len(data):
-        if data[index] != _schema_conf['startByte']:
+        if data[index] != _start_byte:
             raise Exception('Invalid start byte')
-        index += 1
-
-        pdu_type = data[index]
-        if pdu_type in _pdus:
-            index += 1
-            if _pdus[pdu_type].length > len(data) - index:
-                raise Exception('Invalid data length')
-            else:
-                _pdus[pdu_type].decode(data[index:index + _pdus[pdu_type].length])
-                if 'PDU' in _event_handlers:
-                    _event_handlers['PDU'](_pdus[pdu_type].fields)
-
-                index += _pdus[pdu_type].length
-        else:
+
+        if index + 1 == len(data):
+            break
+
+        pdu_type = data[index + 1]
+        pdu = _pdus[pdu_type] if pdu_type < len(_pdus) else None
+        if pdu is None:
             raise Exception('Invalid PDU type')
 
+        if pdu.length > len(data) - index - 2:
+            break
+
+        # Frames are still walked to validate the stream, but only decoded when someone is listening.
+        if on_pdu is not None:
+            pdu.decode(data, index + 2)
+            on_pdu(pdu.fields)
+
+        index += 2 + pdu.length
+
+    return index
+
+
+async def _serve_socket():
+    server = await asyncio.get_event_loop().create_server(_Socket, _conf['Host'], _conf.getint('Port'))
+
+    # Accepted connections inherit the receive buffer size of the listening socket.
+    for sock in server.sockets:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _conf.getint('RecvBuffer'))
+
 
 def on(event):
     def wrapper(func):
-        @functools.wraps(func)
-        def decorator(*args, **kwargs):
-            func(*args, **kwargs)
-
-        _event_handlers[event] = decorator
+        _event_handlers[event] = func
 
-        return decorator
+        return func
 
     return wrapper
 
 
 def load():
-    for name, conf in config.schema['pdu'].items():
-        _pdus[conf['id']] = _PDU(name, conf['header'], conf['body'])
+    pdus = {conf['id']: _PDU(name, conf['header'], conf['body']) for name, conf in config.schema['pdu'].items()}
+    _pdus.extend(pdus.get(pdu_id) for pdu_id in range(max(pdus) + 1))
 
     if _conf['source'] == 'socket':
-        asyncio.get_event_loop().create_task(
-            asyncio.get_event_loop().create_server(
-                _Socket,
-                _conf['Host'],
-                _conf.getint('Port'))
-        )
+        asyncio.get_event_loop().create_task(_serve_socket())
         print(f'schema socket serving {_conf["Host"]}:{_conf.getint("Port")}')
     else:
         _XBee(_conf['Com'], _conf.getint('Baud'), _conf['Mac'])
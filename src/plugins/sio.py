@@ -22,6 +22,7 @@ import json
 
 client = socketio.Client(reconnection=False)
 conf = config.config['sio']
+namespace = conf['Namespace']
 
 
 def connect():
@@ -47,7 +48,7 @@ def connect():
 
             client.connect(
                 conf['Url'],
-                namespaces=[conf['Namespace']],
+                namespaces=[namespace],
                 headers={"Authorization": "Bearer " + access_token},
                 wait=True
             )